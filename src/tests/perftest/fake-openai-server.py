@@ -4,152 +4,312 @@ Args:
     --host: Host to run the server on
     --max-tokens: maximum number of tokens to generate in the response if max_tokens is not provided in the request
     --speed: number of tokens per second per request
+    --workers: number of uvicorn worker processes; the running-requests gauge on
+        /metrics is kept per process, so with more than one worker it only
+        reflects whichever worker serves the scrape
 """
 
 import argparse
 import asyncio
+import logging
+import logging.handlers
+import os
+import queue
 import time
 import uuid
-from typing import Final
+from contextlib import asynccontextmanager
+from typing import Final, Optional
 
+import msgspec
+import orjson
 from fastapi import FastAPI, Request
-from fastapi.responses import Response, StreamingResponse
-from vllm.entrypoints.openai.protocol import (
-    ChatCompletionRequest,
-    ChatCompletionResponseStreamChoice,
-    ChatCompletionStreamResponse,
-    DeltaMessage,
-    UsageInfo,
-)
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global GLOBAL_ARGS
+    if GLOBAL_ARGS is None:
+        # Worker processes import this module by name instead of running it as
+        # __main__; they are spawned with the parent's argv, so parse it again.
+        GLOBAL_ARGS = parse_args()
+    log_listener = setup_logging()
+    clock_task = asyncio.create_task(refresh_current_time())
+    yield
+    clock_task.cancel()
+    log_listener.stop()
+
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+logger = logging.getLogger("fake-openai-server")
 GLOBAL_ARGS = None
 MODEL_NAME = "fake_model_name"
 NUM_RUNNING_REQUESTS = 0
+# Wall-clock seconds for the "created" field, refreshed once a second instead
+# of being read on every request.
+CURRENT_TIME = int(time.time())
+CHUNK_OBJECT_TYPE: Final = "chat.completion.chunk"
+
+
+# Fixed-shape mirrors of vLLM's streaming protocol models. msgspec encodes
+# Structs straight from their slots, which is cheaper than dumping pydantic
+# models; omit_defaults stands in for pydantic's exclude_unset.
+class DeltaMessage(msgspec.Struct, omit_defaults=True):
+    role: Optional[str] = None
+    content: Optional[str] = None
+
+
+class ChatCompletionResponseStreamChoice(msgspec.Struct):
+    index: int
+    delta: DeltaMessage
+    logprobs: None = None
+    finish_reason: Optional[str] = None
+
+
+class UsageInfo(msgspec.Struct):
+    prompt_tokens: int
+    total_tokens: int
+    completion_tokens: int
+
+
+class ChatCompletionStreamResponse(msgspec.Struct, omit_defaults=True):
+    id: str
+    object: str
+    created: int
+    model: str
+    choices: list[ChatCompletionResponseStreamChoice]
+    usage: Optional[UsageInfo] = None
+
+
+CHUNK_ENCODER = msgspec.json.Encoder()
+DONE_DATA = b"data: [DONE]\n\n"
+
+
+def make_chunk_template(delta: DeltaMessage, finish_reason=None):
+    # Only the per-request fields (id, created, usage) differ between
+    # responses; they are patched in with msgspec.structs.replace() rather
+    # than rebuilding the whole chunk.
+    return ChatCompletionStreamResponse(
+        id="",
+        object=CHUNK_OBJECT_TYPE,
+        created=0,
+        choices=[
+            ChatCompletionResponseStreamChoice(
+                index=0, delta=delta, logprobs=None, finish_reason=finish_reason
+            )
+        ],
+        model=MODEL_NAME,
+    )
+
+
+ROLE_CHUNK = make_chunk_template(DeltaMessage(role="assistant", content=""))
+TOKEN_CHUNK = make_chunk_template(DeltaMessage(content="Hello "))
+FINAL_CHUNK = make_chunk_template(DeltaMessage(content="\n"), finish_reason="length")
+
+
+async def refresh_current_time():
+    global CURRENT_TIME
+    while True:
+        CURRENT_TIME = int(time.time())
+        await asyncio.sleep(1)
+
+
+def encode_response_chunks(request_id: str, num_tokens: int):
+    # Every chunk of a response is known up front, so serialize each one once
+    # and only yield the prebuilt bytes from the token loop.
+    created_time = CURRENT_TIME
+
+    def encode_chunk(template, **update):
+        chunk = msgspec.structs.replace(
+            template, id=request_id, created=created_time, **update
+        )
+        return b"data: " + CHUNK_ENCODER.encode(chunk) + b"\n\n"
+
+    role_data = encode_chunk(ROLE_CHUNK)
+    token_data = encode_chunk(TOKEN_CHUNK)
+    final_data = encode_chunk(
+        FINAL_CHUNK,
+        usage=UsageInfo(
+            prompt_tokens=0,
+            completion_tokens=num_tokens,
+            total_tokens=num_tokens,
+        ),
+    )
+    return role_data, token_data, final_data
 
 
 async def generate_fake_response(
     request_id: str,
-    model_name: str,
     num_tokens: int,
     tokens_per_sec: float,
+    role_data: bytes,
+    token_data: bytes,
+    final_data: bytes,
 ):
+    # Pace the stream on the event loop's monotonic clock.
+    loop = asyncio.get_running_loop()
+
     async def sleep_to_target(target: float):
-        sleep_time = target - time.time()
+        sleep_time = target - loop.time()
         if sleep_time > 0:
             await asyncio.sleep(sleep_time)
 
-    start = time.time()
+    start = loop.time()
     global NUM_RUNNING_REQUESTS
 
     if GLOBAL_ARGS.ttft > 0:
         await asyncio.sleep(GLOBAL_ARGS.ttft)
 
-    NUM_RUNNING_REQUESTS += 1
-    created_time = int(time.time())
-    chunk_object_type: Final = "chat.completion.chunk"
-
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(
-            role="assistant",
-            content="",
-        ),
-        logprobs=None,
-        finish_reason=None,
-    )
-    chunk = ChatCompletionStreamResponse(
-        id=request_id,
-        object=chunk_object_type,
-        created=created_time,
-        choices=[choice_data],
-        model=model_name,
-    )
-    data = chunk.model_dump_json(exclude_unset=True)
     token_batch = 20
+    batch_data = token_data * token_batch
 
-    for i in range(num_tokens):
-        if i % token_batch == 0:
+    # The gauge is scraped by the router, so release it even when the client
+    # disconnects and the generator is closed mid-stream.
+    NUM_RUNNING_REQUESTS += 1
+    try:
+        yield role_data
+        # Nothing awaits between the tokens of one batch, so send each batch as
+        # a single write instead of one ASGI message per token.
+        for i in range(0, num_tokens, token_batch):
             await sleep_to_target(start + i / tokens_per_sec)
+            n = min(token_batch, num_tokens - i)
+            yield batch_data if n == token_batch else token_data * n
 
-        text = "Hello "
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=0, delta=DeltaMessage(content=text), logprobs=None, finish_reason=None
-        )
-        chunk = ChatCompletionStreamResponse(
-            id=request_id,
-            object=chunk_object_type,
-            created=created_time,
-            choices=[choice_data],
-            model=model_name,
-        )
-        data = chunk.model_dump_json(exclude_unset=True)
-        yield f"data: {data}\n\n"
-
-    await sleep_to_target(num_tokens / tokens_per_sec + start)
+        await sleep_to_target(num_tokens / tokens_per_sec + start)
 
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0,
-        delta=DeltaMessage(
-            content="\n",
-        ),
-        logprobs=None,
-        finish_reason="length",
-    )
+        yield final_data
+        yield DONE_DATA
+    finally:
+        NUM_RUNNING_REQUESTS -= 1
 
-    chunk = ChatCompletionStreamResponse(
-        id=request_id,
-        object=chunk_object_type,
-        created=created_time,
-        choices=[choice_data],
-        model=model_name,
+    elapsed = loop.time() - start
+    # loop.time() is cached per loop iteration, so an empty stream that never
+    # sleeps can finish with an elapsed time of exactly zero.
+    thp = num_tokens / elapsed if elapsed else float("inf")
+    logger.info(
+        "Finished request with id: %s, elapsed time %s, throughput %s",
+        request_id,
+        elapsed,
+        thp,
     )
 
-    chunk.usage = UsageInfo(
-        prompt_tokens=0,
-        completion_tokens=num_tokens,
-        total_tokens=num_tokens,
-    )
-
-    yield f"data: {data}\n\n"
-    yield "data: [DONE]\n\n"
 
-    NUM_RUNNING_REQUESTS -= 1
-    elapsed = time.time() - start
-    thp = num_tokens / elapsed
-    print(
-        f"Finished request with id: {request_id}, elapsed time {elapsed}, throughput {thp}"
+def bad_request(message: str):
+    # Same error shape vLLM's OpenAI server returns for invalid requests.
+    return ORJSONResponse(
+        status_code=400,
+        content={
+            "object": "error",
+            "message": message,
+            "type": "BadRequestError",
+            "code": 400,
+        },
     )
 
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest, raw_request: Request):
-    global MODEL_NAME
-    request_id = raw_request.get("x-request-id", f"fake_request_id_{uuid.uuid4()}")
-    print(f"Received request with id: {request_id} at {time.time()}")
-    model_name = MODEL_NAME
-    num_tokens = request.max_tokens if request.max_tokens else 100
+async def chat_completions(raw_request: Request):
+    # The router forwards X-Request-Id (as vLLM expects), so only mint an id for
+    # direct clients.
+    request_id = (
+        raw_request.headers.get("x-request-id") or "fake_request_id_" + uuid.uuid4().hex
+    )
+    logger.info("Received request with id: %s", request_id)
+    # Only max_tokens drives the fake response, so skip building a full
+    # ChatCompletionRequest model and read it straight off the raw body.
+    try:
+        request = orjson.loads(await raw_request.body())
+    except orjson.JSONDecodeError as e:
+        return bad_request(f"Invalid JSON body: {e}")
+    if not isinstance(request, dict):
+        return bad_request("Request body must be a JSON object")
+    max_tokens = request.get("max_tokens")
+    if max_tokens is not None and (
+        not isinstance(max_tokens, int) or isinstance(max_tokens, bool)
+    ):
+        return bad_request("max_tokens must be an integer")
+    # Negative values stream no tokens, as before; clamp them here so the
+    # Content-Length below matches exactly what the generator yields.
+    num_tokens = max(0, max_tokens) if max_tokens else 100
     tokens_per_sec = GLOBAL_ARGS.speed
+    role_data, token_data, final_data = encode_response_chunks(request_id, num_tokens)
+    # The whole body is known before streaming starts, so send an exact
+    # Content-Length and let uvicorn skip chunked transfer encoding.
+    content_length = (
+        len(role_data) + len(token_data) * num_tokens + len(final_data) + len(DONE_DATA)
+    )
     return StreamingResponse(
-        generate_fake_response(request_id, model_name, num_tokens, tokens_per_sec),
+        generate_fake_response(
+            request_id,
+            num_tokens,
+            tokens_per_sec,
+            role_data,
+            token_data,
+            final_data,
+        ),
         media_type="text/event-stream",
+        headers={"content-length": str(content_length)},
     )
 
 
+# The model name is fixed for the lifetime of the server, so it is baked into
+# the /metrics template and the /v1/models body once instead of per request.
+METRICS_TEMPLATE = (
+    b"# HELP vllm:num_requests_running Number of requests currently running on GPU.\n"
+    b"# TYPE vllm:num_requests_running gauge\n"
+    b'vllm:num_requests_running{model_name="%(model)s"} %%d\n'
+    b"# HELP vllm:num_requests_swapped Number of requests swapped to CPU.\n"
+    b"# TYPE vllm:num_requests_swapped gauge\n"
+    b'vllm:num_requests_swapped{model_name="%(model)s"} 0.0\n'
+    b"# HELP vllm:num_requests_waiting Number of requests waiting to be processed.\n"
+    b"# TYPE vllm:num_requests_waiting gauge\n"
+    b'vllm:num_requests_waiting{model_name="%(model)s"} 0.0\n'
+) % {b"model": MODEL_NAME.encode()}
+MODELS_BODY = orjson.dumps(
+    {
+        "object": "list",
+        "data": [
+            {
+                "id": MODEL_NAME,
+                "object": "model",
+                "created": int(time.time()),
+                "owned_by": "vllm",
+                "root": MODEL_NAME,
+                "parent": None,
+            }
+        ],
+    }
+)
+IS_SLEEPING_BODY = b'{"is_sleeping":false}'
+
+
 @app.get("/metrics")
 async def metrics():
-    global NUM_RUNNING_REQUESTS, MODEL_NAME
-    content = f"""# HELP vllm:num_requests_running Number of requests currently running on GPU.
-# TYPE vllm:num_requests_running gauge
-vllm:num_requests_running{{model_name="{MODEL_NAME}"}} {NUM_RUNNING_REQUESTS}
-# HELP vllm:num_requests_swapped Number of requests swapped to CPU.
-# TYPE vllm:num_requests_swapped gauge
-vllm:num_requests_swapped{{model_name="{MODEL_NAME}"}} 0.0
-# HELP vllm:num_requests_waiting Number of requests waiting to be processed.
-# TYPE vllm:num_requests_waiting gauge
-vllm:num_requests_waiting{{model_name="{MODEL_NAME}"}} 0.0"""
+    content = METRICS_TEMPLATE % NUM_RUNNING_REQUESTS
+    return Response(content=content, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/v1/models")
+async def models():
+    return Response(content=MODELS_BODY, media_type="application/json")
 
-    return Response(content=content, media_type="text/plain")
+
+@app.get("/is_sleeping")
+async def is_sleeping():
+    return Response(content=IS_SLEEPING_BODY, media_type="application/json")
+
+
+def setup_logging():
+    # Log records are handed to a background thread through a queue so that
+    # the event loop never blocks on writing to stdout.
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    listener.start()
+    return listener
 
 
 def parse_args():
@@ -159,6 +319,13 @@ def parse_args():
     parser.add_argument("--max-tokens", type=int, default=100)
     parser.add_argument("--speed", type=int, default=100)
     parser.add_argument("--ttft", type=float, default=0)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of uvicorn worker processes; vllm:num_requests_running on "
+        "/metrics is per process and inaccurate with more than one worker",
+    )
     args = parser.parse_args()
     return args
 
@@ -167,4 +334,25 @@ if __name__ == "__main__":
     import uvicorn
 
     GLOBAL_ARGS = parse_args()
-    uvicorn.run(app, host=GLOBAL_ARGS.host, port=GLOBAL_ARGS.port)
+    if GLOBAL_ARGS.workers > 1:
+        logger.warning(
+            "Running %d workers; vllm:num_requests_running on /metrics only "
+            "counts the requests of the worker that serves each scrape",
+            GLOBAL_ARGS.workers,
+        )
+        # Multiple workers need an import string so that each process can load
+        # the app itself.
+        module_name = os.path.splitext(os.path.basename(__file__))[0]
+        app_target = f"{module_name}:app"
+    else:
+        app_target = app
+    uvicorn.run(
+        app_target,
+        host=GLOBAL_ARGS.host,
+        port=GLOBAL_ARGS.port,
+        workers=GLOBAL_ARGS.workers,
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        # uvicorn's "auto" loop/http already pick uvloop and httptools when
+        # uvicorn[standard] is installed, and fall back to asyncio/h11 otherwise.
+        access_log=False,
+    )